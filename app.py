@@ -5,6 +5,7 @@
 
 # System
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 # Data
 import pandas as pd
@@ -72,70 +73,88 @@ uf_br = {
 start = datetime(2025, 1, 2, 23)  # Start date and time (UTC)
 end = datetime(2025, 1, 5, 23)  # End date and time (UTC)
 
-datasets = []
+# Output
+output_dir = "./output"
+output_path = os.path.join(output_dir, "capitals_br_daily_prec.parquet")
 
-if start > end:
-    print("The start date must be earlier than or equal to the end date.")
-else:
-    print(f"🔽 Downloading and processing data from {start} to {end}")
-    dt = start
-    while dt <= end:
-        try:
-            # 1. Download the GRIB2 file for the current hour
-            ut.download_merge_cptec(dt)
+# Capitals shapefile (and the GeoParquet cache of the capitals extracted from it)
+path_gdf = r'.\BR_Municipios_2024\BR_Municipios_2024.shp'
+path_capitals_cache = "./cache/capitals_br.parquet"
 
-            # 2. Build the file path
-            filename = f"./merge_data/MERGE_CPTEC_{dt.strftime('%Y%m%d%H')}.grib2"
 
-            # 3. Open the GRIB2 file using cfgrib
-            ds = xr.open_dataset(filename, engine="cfgrib", decode_timedelta=True)
-            
-            # 4. Keep only the 'prec' variable
-            print(ds.data_vars)
-            ds = ds[["prec"]]
+def main():
+    """
+    Runs the ETL pipeline for the period from start to end.
+    """
+    os.makedirs(output_dir, exist_ok=True)
 
-            # 5. Fix coordinates: convert longitude and sort lat/lon
-            ds = ut.fix_coordinates(ds)
+    files = []
+    df_br = None
 
-            # 6. Assign valid_time as a new dimension
-            ds = ds.expand_dims("valid_time")
+    if start > end:
+        print("The start date must be earlier than or equal to the end date.")
+    else:
+        print(f"🔽 Downloading and processing data from {start} to {end}")
 
-            # 7. Append to the list of datasets
-            datasets.append(ds)
+        # Hours to be downloaded, from start to end (inclusive)
+        hours = [start + timedelta(hours=i) for i in range(int((end - start).total_seconds() // 3600) + 1)]
 
-        except Exception as e:
-            print(f"❌ Failed to process {dt.strftime('%Y-%m-%d %H:%M')} - {e}")
+        # 1. Reuse the daily totals saved by previous runs, keeping only the hours of the days
+        #    that are missing or were computed from fewer than 24 hours
+        df_br = ut.load_cached_daily_prec(output_path, path_gdf, uf_br)
+        if df_br is not None:
+            hours = ut.hours_to_process(hours, df_br)
+            print(f"♻️ {len(df_br)} days loaded from {output_path}, {len(hours)} hours left to process")
 
-        # Advance to the next hour
-        dt += timedelta(hours=1)
+        # 2. Download the GRIB2 files concurrently, reusing pooled connections
+        with ThreadPoolExecutor(max_workers=16) as ex:
+            filenames = list(ex.map(lambda d: ut.download_merge_cptec(d, session=ut.SESSION), hours))
 
-if datasets:
-    print(f"🧩 Concatenating {len(datasets)} hourly datasets...")
-    
-    # 8. Concatenate all datasets along the 'valid_time' dimension
-    ds_all = xr.concat(datasets, dim="valid_time")
-else:
-    print("⚠️ No datasets to concatenate.")
+        # 3. Keep only the hours whose GRIB2 file is available on disk
+        for dt, filename in zip(hours, filenames):
+            if os.path.exists(filename):
+                files.append(filename)
+            else:
+                print(f"❌ Failed to process {dt.strftime('%Y-%m-%d %H:%M')} - File not found: {filename}")
 
-# 9. Aggregate to daily totals using 12Z-to-11Z window
-ds_daily = ut.diary_prec_12z(ds_all)
+    ds_cells = None
+    if files:
+        print(f"🧩 Decoding {len(files)} hourly datasets...")
 
-# 10. Mask the data using the capitals shapefile
-path_gdf = r'.\BR_Municipios_2024\BR_Municipios_2024.shp'
+        # 4. Load the capitals from the shapefile
+        gdf_capitals = ut.extract_capitals_from_shapefile(path_gdf, uf_br, cache_path=path_capitals_cache)
 
-gdf_capitals = ut.extract_capitals_from_shapefile(path_gdf, uf_br)
+        # 5. Decode the GRIB2 files in a pool of processes (CPU-bound). Each worker returns only
+        #    the grid cells inside the capitals, so the full grids never leave the workers
+        ds_cells = ut.load_capitals_hourly(files, gdf_capitals)
 
-# 11. Extract time series for each capital
-df_br = ut.extract_capitals_timeseries(ds_daily, gdf_capitals)
+    if ds_cells is not None:
+        # 6. Aggregate to daily totals using 12Z-to-11Z window
+        ds_daily = ut.diary_prec_12z(ds_cells)
 
-# 12. Save the DataFrame to a Parquet file
-# Output
-output_dir = "./output"
-os.makedirs(output_dir, exist_ok=True)
+        # 7. Extract time series for each capital
+        df_new = ut.extract_capitals_timeseries(ds_daily, gdf_capitals)
+
+        # Number of hourly files each day was computed from (days with fewer than 24 are recomputed next run)
+        n_hours = pd.Series([ut.ref_time_12z(t) for t in ds_cells["valid_time"].values]).value_counts()
+        df_new["n_hours"] = n_hours.reindex(df_new.index, fill_value=0).astype("uint8")
+        del ds_cells, ds_daily
+
+        # 8. Merge with the cached days (keeping the most complete version of each day) and sort by ref_time
+        df_br = ut.merge_daily_prec(df_br, df_new)
+
+        # 9. Save the DataFrame to a Parquet file (quantized to 0.01 mm)
+        ut.save_daily_prec_parquet(df_br, output_path)
+        print("✅ File Saved as Parquet")
+
+        # 10. Save the DataFrame.Parquet to MongoDB
+        ut.save_parquet_to_mongodb(output_path)
+    elif df_br is not None:
+        print("✅ All days already processed, nothing to update.")
+    else:
+        print("⚠️ No datasets to process.")
 
-# Save as Parquet
-df_br.to_parquet(os.path.join(output_dir, "capitals_br_daily_prec.parquet"))
-print("✅ File Saved as Parquet")
 
-# 13. Save the DataFrame.Parquet to MongoDB
-ut.save_parquet_to_mongodb("./output/capitals_br_daily_prec.parquet")
\ No newline at end of file
+# The guard keeps the worker processes (spawned on Windows) from re-running the pipeline on import
+if __name__ == "__main__":
+    main()
\ No newline at end of file
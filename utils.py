@@ -4,11 +4,19 @@
 
 # System
 import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 
 # Data
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import xarray as xr
+import rioxarray  # registers the .rio accessor on xarray objects
 import geopandas as gpd
+from rasterio import features
 from shapely.geometry import mapping
 
 # Datetime
@@ -18,20 +26,42 @@ from datetime import timedelta
 # Web
 import requests
 import urllib3
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 #NoSQL - MongoDB
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne
+
+# Shared HTTP session: keeps TCP/TLS connections alive across hourly downloads
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=32,
+                                      pool_maxsize=32,
+                                      max_retries=Retry(total=3, backoff_factor=0.5)))
+
+# Smallest size (in bytes) of a GRIB2 file considered complete on disk
+MIN_BYTES = 1024
+
+# Precipitation is stored in Parquet/MongoDB as unsigned integers in units of PREC_SCALE_FACTOR mm
+PREC_SCALE_FACTOR = 0.01
+
+# Number of records sent to MongoDB per bulk write
+MONGO_BATCH_SIZE = 1_000
 
 # ________________________________FUNCTIONS_______________________________________
 
-def download_merge_cptec(date: datetime, output_dir: str = "./merge_data"):
+def download_merge_cptec(date: datetime,
+                         output_dir: str = "./merge_data",
+                         session: requests.Session = SESSION,
+                         force: bool = False):
     """
     Download a MERGE_CPTEC GRIB2 file for a specific date and time.
 
     Parameters:
     - date (datetime): The date and hour to download (UTC).
     - output_dir (str): Directory where the file will be saved.
+    - session (requests.Session): HTTP session used for the request (default is the shared pooled SESSION).
+    - force (bool): Download again even if the file is already on disk (default is False).
     """
     # Create output directory if it doesn't exist
     os.makedirs(output_dir, exist_ok=True)
@@ -42,20 +72,31 @@ def download_merge_cptec(date: datetime, output_dir: str = "./merge_data"):
     )
     
     filename = os.path.join(output_dir, f"MERGE_CPTEC_{date.strftime('%Y%m%d%H')}.grib2")
+
+    # Skip the download if the file is already on disk from a previous run
+    if not force and os.path.exists(filename) and os.path.getsize(filename) >= MIN_BYTES:
+        print(f"⏭️ Already downloaded: {filename}")
+        return filename
     
     print(f"🔄 Downloading: {url}")
     
     # Perform the download, ignoring SSL certificate verification
-    response = requests.get(url, stream=True, verify=False)
-    
-    if response.status_code == 200:
-        # Write the file in binary mode, in chunks
-        with open(filename, "wb") as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                f.write(chunk)
-        print(f"✅ Saved to: {filename}")
-    else:
-        print(f"❌ Failed to download {url} - Status {response.status_code}")
+    try:
+        # Closing the response returns the connection to the session pool
+        with session.get(url, stream=True, verify=False, timeout=(5, 60)) as response:
+            if response.status_code == 200:
+                # Stream the body straight to disk in 1 MiB chunks, to a temporary file
+                # so an interrupted download never looks like a complete one
+                response.raw.decode_content = True
+                with open(filename + ".part", "wb") as f:
+                    shutil.copyfileobj(response.raw, f, length=1 << 20)
+                os.replace(filename + ".part", filename)
+                print(f"✅ Saved to: {filename}")
+            else:
+                print(f"❌ Failed to download {url} - Status {response.status_code}")
+    except (requests.RequestException, urllib3.exceptions.HTTPError) as e:
+        # Reading response.raw directly raises urllib3 errors, not requests ones
+        print(f"❌ Failed to download {url} - {e}")
 
     print(filename)
     
@@ -87,6 +128,40 @@ def fix_coordinates(ds: xr.Dataset) -> xr.Dataset:
     return ds
 
 
+def preprocess_merge(ds: xr.Dataset) -> xr.Dataset:
+    """
+    Prepare a single hourly MERGE_CPTEC dataset right after it is opened,
+    keeping only the precipitation variable (as float32) and fixing its coordinates.
+
+    Parameters:
+    - ds (xr.Dataset): Hourly dataset as read by cfgrib.
+
+    Returns:
+    - xr.Dataset: Dataset with only 'prec' (float32), 'valid_time' and adjusted, sorted coordinates.
+    """
+    ds = ds[["prec"]]
+
+    # Drop the scalar GRIB coordinates other than valid_time (time, step, surface...),
+    # so there is nothing to compare or concatenate across files besides 'prec'
+    ds = ds.drop_vars([c for c in ds.coords if c not in ("valid_time", "latitude", "longitude")])
+
+    # float32 halves the memory traffic of every reduction downstream
+    return fix_coordinates(ds.astype({"prec": "float32"}))
+
+
+def ref_time_12z(time: datetime) -> pd.Timestamp:
+    """
+    Start of the 12Z-to-11Z accumulation window containing a given time.
+
+    Parameters:
+    - time (datetime): Hourly time (UTC).
+
+    Returns:
+    - pd.Timestamp: 12Z start of the accumulation window (the 'ref_time' of diary_prec_12z).
+    """
+    return (pd.Timestamp(time) - pd.Timedelta(hours=12)).floor("1D") + pd.Timedelta(hours=12)
+
+
 def diary_prec_12z(ds: xr.Dataset) -> xr.Dataset:
     """
     Aggregate hourly precipitation data into daily totals, using a 12Z-to-11Z window.
@@ -97,46 +172,70 @@ def diary_prec_12z(ds: xr.Dataset) -> xr.Dataset:
     Returns:
     - xr.Dataset: Daily aggregated dataset with 'ref_time' indicating the 12Z start of each accumulation window.
     """
-    ds = ds.copy()
-
-    # Define the start of the 12Z–11Z accumulation window
-    ref_time = (ds.valid_time - pd.Timedelta(hours=12)).dt.floor("1D") + pd.Timedelta(hours=12)
-    ds.coords["ref_time"] = ref_time
-
-    # Group by ref_time and sum the precipitation
-    ds_daily = ds.groupby("ref_time").sum()
+    # One chunk per accumulation window (the first one holds the hours before the first 12Z,
+    # then 24 hours each), so each window sits in exactly one chunk. The chunk sizes are the
+    # run lengths of the window start of each hour, which also handles missing hours
+    window_start = (ds.indexes["valid_time"] - pd.Timedelta(hours=12)).floor("1D")
+    _, chunk_sizes = np.unique(window_start, return_counts=True)
+    ds = ds.chunk({"valid_time": tuple(chunk_sizes.tolist())})
+
+    # Sum the precipitation over 24-hour windows starting at 12Z, labelled by their start
+    # (each window is reduced within its own chunk; windows without any hour are left as NaN)
+    ds_daily = ds.resample(valid_time="24h", offset="12h", label="left").sum(engine="flox",
+                                                                              method="blockwise",
+                                                                              min_count=1)
+    ds_daily = ds_daily.rename(valid_time="ref_time")
 
     ds_daily.attrs["aggregation_period"] = "From 12Z to 11Z (ref_time = 12Z start of period)"
     
     return ds_daily
 
 
-def extract_capitals_from_shapefile(shapefile_path: str, capitals_dict: dict) -> gpd.GeoDataFrame:
+def extract_capitals_from_shapefile(shapefile_path: str,
+                                    capitals_dict: dict,
+                                    cache_path: str | None = None) -> gpd.GeoDataFrame:
     """
     Extracts the capital cities from a shapefile of Brazilian municipalities using a UF-to-capital dictionary.
 
     Parameters:
     - shapefile_path (str): Path to the shapefile containing Brazilian municipalities.
     - capitals_dict (dict): Dictionary mapping UF abbreviations (e.g., 'SP') to capital city names (e.g., 'São Paulo').
+    - cache_path (str | None): GeoParquet file where the extracted capitals are cached between runs (default is None, no cache).
+      The cache is reused only if it is newer than the shapefile and holds the same capitals as capitals_dict.
 
     Returns:
     - GeoDataFrame: Filtered GeoDataFrame containing only the capital cities.
     """
-    # Load the shapefile
-    gdf = gpd.read_file(shapefile_path)
-
-    # Filter rows where UF and city name match the dictionary
-    gdf_capitals = gdf[gdf.apply(
-        lambda row: row['SIGLA_UF'] in capitals_dict and row['NM_MUN'] == capitals_dict[row['SIGLA_UF']],
-        axis=1
-    )].copy()
+    if (cache_path is not None and os.path.exists(cache_path)
+            and os.path.getmtime(cache_path) >= os.path.getmtime(shapefile_path)):
+        gdf_capitals = gpd.read_parquet(cache_path)
+        if dict(zip(gdf_capitals['SIGLA_UF'], gdf_capitals['NM_MUN'])) == capitals_dict:
+            print(f"♻️ Capitals loaded from {cache_path}")
+            return gdf_capitals
+
+    # Load only the needed columns of the shapefile, reading in bulk through pyogrio/Arrow
+    gdf = gpd.read_file(shapefile_path,
+                        engine="pyogrio",
+                        use_arrow=True,
+                        columns=['SIGLA_UF', 'NM_MUN'])
+
+    # Keep only the municipalities of the UFs in the dictionary
+    gdf = gdf[gdf['SIGLA_UF'].isin(capitals_dict)]
+
+    # Filter rows where the city name matches the capital expected for its UF
+    expected = gdf['SIGLA_UF'].map(capitals_dict)
+    gdf_capitals = gdf[gdf['NM_MUN'] == expected].copy()
 
     gdf_capitals.reset_index(drop=True, inplace=True)
 
+    if cache_path is not None:
+        os.makedirs(os.path.dirname(cache_path) or ".", exist_ok=True)
+        gdf_capitals.to_parquet(cache_path)
+
     return gdf_capitals
 
 
-def mask_data(ds: xr.Dataset, mask: str) -> xr.Dataset:
+def mask_data(ds: xr.Dataset, mask: str, drop: bool = False) -> xr.Dataset:
     """
     Mask data within a geographical extension directly from a shapefile.
 
@@ -148,10 +247,14 @@ def mask_data(ds: xr.Dataset, mask: str) -> xr.Dataset:
         mask : str, path object or file-like object
             Shapefile to mask dataset.
 
+        drop : bool, default False
+            If True, drop the cells outside the mask geometries instead of
+            setting them to NaN.
+
     Returns
     -------
         ``xarray.Dataset``
-            Masked data.
+            Masked data, restricted to the bounding box of the mask geometries.
     """
     if isinstance(mask, gpd.GeoDataFrame) is True:
         # Do not read from shapefile
@@ -160,6 +263,19 @@ def mask_data(ds: xr.Dataset, mask: str) -> xr.Dataset:
         # Read from a shapefile
         geo_df = gpd.read_file(mask)
 
+    # Subset the dataset to the bounding box of the geometries (padded by one cell),
+    # so the clip below only rasterizes the area around them. Geometries without a CRS
+    # are taken as already in the dataset CRS, as rio.clip does
+    bounds_df = geo_df.to_crs("epsg:4326") if geo_df.crs is not None else geo_df
+    minx, miny, maxx, maxy = bounds_df.total_bounds
+    dx = abs(float(ds.longitude.diff("longitude").mean()))
+    dy = abs(float(ds.latitude.diff("latitude").mean()))
+    lat_slice = slice(miny - dy, maxy + dy)
+    if ds.latitude[0] > ds.latitude[-1]:
+        # Latitudes in descending order
+        lat_slice = slice(maxy + dy, miny - dy)
+    ds = ds.sel(longitude=slice(minx - dx, maxx + dx), latitude=lat_slice)
+
     # Set the spatial dimensions of the dataset
     ds.rio.set_spatial_dims(x_dim="longitude", y_dim="latitude", inplace=True)
     
@@ -167,54 +283,409 @@ def mask_data(ds: xr.Dataset, mask: str) -> xr.Dataset:
     ds.rio.write_crs("epsg:4326", inplace=True)
 
     # Clip using a GeoDataFrame
-    return ds.rio.clip(geo_df.geometry.apply(mapping), geo_df.crs, drop=False)
+    return ds.rio.clip(geo_df.geometry.apply(mapping), geo_df.crs, drop=drop)
+
+
+def rasterize_capitals(ds: xr.Dataset, gdf_capitals: gpd.GeoDataFrame) -> xr.DataArray:
+    """
+    Rasterizes all capital polygons at once onto the dataset grid.
+
+    Parameters:
+    - ds (xr.Dataset): Gridded dataset with 'latitude' and 'longitude' dimensions (EPSG:4326).
+    - gdf_capitals (gpd.GeoDataFrame): GeoDataFrame with capital geometries.
+
+    Returns:
+    - xr.DataArray: 2D 'capital_id' labels aligned to the grid, where cells inside the i-th capital
+      of gdf_capitals are labelled i + 1 and cells outside every capital are labelled 0.
+    """
+    # Geometries in the same CRS as the dataset
+    geometries = gdf_capitals.to_crs("epsg:4326").geometry
+
+    # Affine transform of the grid (cell centers inside a polygon are burned, as in rio.clip)
+    transform = ds.rio.set_spatial_dims(x_dim="longitude", y_dim="latitude").rio.transform()
+
+    labels = features.rasterize(
+        zip(geometries, range(1, len(geometries) + 1)),
+        out_shape=(ds.sizes["latitude"], ds.sizes["longitude"]),
+        transform=transform,
+        fill=0,
+        dtype="int16",
+    )
+
+    return xr.DataArray(labels,
+                        dims=("latitude", "longitude"),
+                        coords={"latitude": ds.latitude, "longitude": ds.longitude},
+                        name="capital_id")
+
+
+def select_capital_cells(ds: xr.Dataset, gdf_capitals: gpd.GeoDataFrame) -> xr.Dataset:
+    """
+    Keeps only the grid cells inside some capital, so later steps never touch the rest of the grid.
 
+    Parameters:
+    - ds (xr.Dataset): Gridded dataset with 'latitude' and 'longitude' dimensions (EPSG:4326).
+    - gdf_capitals (gpd.GeoDataFrame): GeoDataFrame with capital geometries.
+
+    Returns:
+    - xr.Dataset: Dataset where 'latitude' and 'longitude' are replaced by a 'cell' dimension,
+      with a 'capital_id' coordinate labelling each cell as in rasterize_capitals.
+    """
+    iy, ix, capital_id = capital_cell_indices(ds, gdf_capitals)
+
+    # Vectorized pointwise selection of the labelled cells
+    ds_cells = ds.isel(latitude=xr.DataArray(iy, dims="cell"),
+                       longitude=xr.DataArray(ix, dims="cell"))
 
-def extract_capitals_timeseries(ds_daily: xr.Dataset, gdf_capitals: gpd.GeoDataFrame) -> pd.DataFrame:
+    return ds_cells.assign_coords(capital_id=("cell", capital_id))
+
+
+def capital_cell_indices(ds: xr.Dataset,
+                         gdf_capitals: gpd.GeoDataFrame) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Finds the grid cells inside some capital.
+
+    Parameters:
+    - ds (xr.Dataset): Gridded dataset with 'latitude' and 'longitude' dimensions (EPSG:4326).
+    - gdf_capitals (gpd.GeoDataFrame): GeoDataFrame with capital geometries.
+
+    Returns:
+    - tuple: Latitude and longitude indices of the cells, and the capital id of each cell
+      (as in rasterize_capitals).
+    """
+    # Label the grid cells of every capital in a single rasterization
+    labels = rasterize_capitals(ds, gdf_capitals).values
+    iy, ix = np.nonzero(labels)
+
+    return iy, ix, labels[iy, ix]
+
+
+def open_merge_hour(path: str) -> xr.Dataset:
+    """
+    Opens one hourly MERGE GRIB2 file, keeping only 'prec' with fixed coordinates.
+
+    Parameters:
+    - path (str): Path to the GRIB2 file.
+
+    Returns:
+    - xr.Dataset: Lazily loaded dataset (close it, or use it as a context manager).
+    """
+    # No .idx sidecar file is written, since each file is only read once
+    ds = xr.open_dataset(path,
+                         engine="cfgrib",
+                         decode_timedelta=True,
+                         backend_kwargs={"indexpath": ""})
+
+    return preprocess_merge(ds)
+
+
+def load_capital_cells(path: str, iy: np.ndarray, ix: np.ndarray) -> tuple[np.datetime64, np.ndarray] | None:
+    """
+    Decodes one hourly GRIB2 file and keeps only the given grid cells.
+    Runs in the worker processes of load_capitals_hourly, so only the selected cells
+    (not the full grid) are sent back to the main process.
+
+    Parameters:
+    - path (str): Path to the GRIB2 file.
+    - iy (np.ndarray): Latitude indices of the cells.
+    - ix (np.ndarray): Longitude indices of the cells.
+
+    Returns:
+    - tuple | None: Valid time of the file and the precipitation of each cell,
+      or None if the file could not be decoded.
+    """
+    try:
+        with open_merge_hour(path) as ds:
+            return ds["valid_time"].values, ds["prec"].values[iy, ix]
+    except Exception as e:
+        print(f"❌ Failed to decode {path}: {e}")
+        return None
+
+
+def load_capitals_hourly(files: list,
+                         gdf_capitals: gpd.GeoDataFrame,
+                         max_workers: int | None = None) -> xr.Dataset | None:
+    """
+    Decodes the hourly GRIB2 files in a pool of processes, keeping only the grid cells inside the capitals.
+
+    Parameters:
+    - files (list): Paths to the hourly GRIB2 files (all on the same grid).
+    - gdf_capitals (gpd.GeoDataFrame): GeoDataFrame with capital geometries.
+    - max_workers (int | None): Number of worker processes (defaults to the number of CPUs).
+
+    Returns:
+    - xr.Dataset | None: Dataset with 'prec' over ('valid_time', 'cell') and a 'capital_id'
+      coordinate on 'cell' (as in select_capital_cells), or None if no file could be decoded.
+    """
+    # All files share the same grid, so the cells are labelled once, on the first file that
+    # can be decoded (whose cells are kept here instead of being decoded again by a worker)
+    results = []
+    for i, path in enumerate(files):
+        try:
+            with open_merge_hour(path) as ds_grid:
+                iy, ix, capital_id = capital_cell_indices(ds_grid, gdf_capitals)
+                results.append((ds_grid["valid_time"].values, ds_grid["prec"].values[iy, ix]))
+            break
+        except Exception as e:
+            print(f"❌ Failed to decode {path}: {e}")
+    else:
+        return None
+
+    # Decoding GRIB2 is CPU-bound: each worker decodes whole files and returns only their cells
+    with ProcessPoolExecutor(max_workers=max_workers) as ex:
+        results += [r for r in ex.map(partial(load_capital_cells, iy=iy, ix=ix), files[i + 1:]) if r is not None]
+
+    times, values = zip(*results)
+    ds_cells = xr.Dataset({"prec": (("valid_time", "cell"), np.stack(values))},
+                          coords={"valid_time": np.array(times, dtype="datetime64[ns]"),
+                                  "capital_id": ("cell", capital_id)})
+
+    return ds_cells.sortby("valid_time")
+
+
+def extract_capitals_timeseries(ds_daily: xr.Dataset,
+                                gdf_capitals: gpd.GeoDataFrame,
+                                mode: str = "area") -> pd.DataFrame:
     """
     Extracts the mean daily precipitation time series for each Brazilian capital.
 
     Parameters:
-    - ds_daily (xr.Dataset): Daily gridded dataset with 'latitude' and 'longitude' dimensions.
+    - ds_daily (xr.Dataset): Daily gridded dataset with 'latitude' and 'longitude' dimensions,
+      or (in 'area' mode) daily capital cells already selected by select_capital_cells.
     - gdf_capitals (gpd.GeoDataFrame): GeoDataFrame with capital geometries.
+    - mode (str): 'area' to average the grid cells inside each capital polygon (default),
+      or 'point' to take the grid cell nearest to a representative point of each capital.
 
     Returns:
     - pd.DataFrame: Wide-format DataFrame with 'ref_time' as index and one column per capital.
     """
-    df_br_list = []
+    if mode == "point":
+        return extract_capitals_points(ds_daily, gdf_capitals)
+    elif mode != "area":
+        raise ValueError(f"Invalid mode: {mode!r} (expected 'area' or 'point')")
+
+    print(f"🔍 Masking data for {len(gdf_capitals)} capitals...")
+
+    # Keep only the grid cells inside some capital, unless the caller already did
+    # (selecting them before the daily aggregation saves aggregating the whole grid)
+    if "cell" not in ds_daily.dims:
+        ds_daily = select_capital_cells(ds_daily, gdf_capitals)
 
-    for capital in gdf_capitals['NM_MUN']:
-        print(f"🔍 Masking data for {capital}...")
+    # Mean over the cells of each capital in a single grouped reduction
+    # (the labels may have been chunked along with the data, and grouping needs them in memory)
+    capital_mean = ds_daily["prec"].groupby(ds_daily["capital_id"].compute()).mean(engine="flox")
+    capital_mean = capital_mean.transpose("ref_time", "capital_id")
 
-        mask = gdf_capitals[gdf_capitals["NM_MUN"] == capital]
-        ds_capital = mask_data(ds_daily, mask)
+    # Fill one column per capital, in the same order as gdf_capitals
+    # (capitals without any grid cell inside them are left as NaN)
+    times = capital_mean.ref_time.values
+    out = np.full((times.size, len(gdf_capitals)), np.nan, dtype="float32")
+    out[:, capital_mean.capital_id.values.astype(int) - 1] = capital_mean.values
 
-        # Mean over spatial dimensions
-        capital_ds_mean = ds_capital.mean(dim=['latitude', 'longitude'])
+    # Wide-format DataFrame with ref_time as index and capital names as columns
+    df_br = pd.DataFrame(out,
+                         index=pd.DatetimeIndex(times, name="ref_time"),
+                         columns=gdf_capitals['NM_MUN'].values)
 
-        # Convert to DataFrame
-        df_capital = capital_ds_mean.to_dataframe().dropna()
+    # Drop days without data for any capital
+    df_br = df_br.dropna(how="all")
 
-        # Drop unnecessary columns
-        df_capital = df_capital.drop(columns=[col for col in ['spatial_ref', 'step', 'surface'] if col in df_capital.columns])
+    return df_br
 
-        # Rename 'prec' to capital name
-        df_capital = df_capital.rename(columns={"prec": capital})
 
-        # Append
-        df_br_list.append(df_capital[[capital]])  # Keep only the renamed column
+def extract_capitals_points(ds_daily: xr.Dataset, gdf_capitals: gpd.GeoDataFrame) -> pd.DataFrame:
+    """
+    Extracts the daily precipitation time series at the grid cell nearest to each Brazilian capital.
 
-    # Concatenate on columns (axis=1) using ref_time as index
-    df_br = pd.concat(df_br_list, axis=1)
+    Parameters:
+    - ds_daily (xr.Dataset): Daily gridded dataset with 'latitude' and 'longitude' dimensions.
+    - gdf_capitals (gpd.GeoDataFrame): GeoDataFrame with capital geometries.
+
+    Returns:
+    - pd.DataFrame: Wide-format DataFrame with 'ref_time' as index and one column per capital.
+    """
+    print(f"📍 Selecting nearest grid cells for {len(gdf_capitals)} capitals...")
+
+    # A point guaranteed to lie within each capital, in the same CRS as the dataset
+    points = gdf_capitals.to_crs("epsg:4326").geometry.representative_point()
+    capitals = gdf_capitals['NM_MUN'].values
+
+    lons = xr.DataArray(points.x.values, dims="capital", coords={"capital": capitals})
+    lats = xr.DataArray(points.y.values, dims="capital", coords={"capital": capitals})
+
+    # Vectorized nearest-neighbor lookup of all capitals at once
+    capital_prec = ds_daily["prec"].sel(longitude=lons, latitude=lats, method="nearest")
+
+    # Wide-format DataFrame with ref_time as index and capital names as columns
+    df_br = capital_prec.transpose("ref_time", "capital").to_pandas()
+    df_br.columns.name = None
 
     return df_br
 
 
+def load_cached_daily_prec(parquet_path: str, shapefile_path: str, capitals_dict: dict) -> pd.DataFrame | None:
+    """
+    Loads the daily precipitation saved by a previous run, so only the missing days are recomputed.
+
+    Parameters:
+    - parquet_path (str): Path to the Parquet file written by a previous run.
+    - shapefile_path (str): Path to the shapefile the capitals were extracted from.
+    - capitals_dict (dict): Dictionary mapping UF abbreviations to the capital names expected in the file.
+
+    Returns:
+    - pd.DataFrame | None: Wide-format DataFrame with 'ref_time' as index, one column per capital and
+      the 'n_hours' column, or None if there is no Parquet file or it cannot be reused (the shapefile
+      was modified after it was written, it holds other capitals, or it has no 'n_hours' column).
+    """
+    if not os.path.exists(parquet_path):
+        return None
+
+    # The cached values depend on the capital geometries, so a newer shapefile invalidates them
+    if os.path.exists(shapefile_path) and os.path.getmtime(shapefile_path) > os.path.getmtime(parquet_path):
+        print(f"🔄 Shapefile changed since {parquet_path} was written, recomputing all days...")
+        return None
+
+    df = load_daily_prec_parquet(parquet_path)
+
+    # Files from earlier versions do not record how many hours each day was computed from
+    if "n_hours" not in df.columns:
+        print(f"🔄 {parquet_path} has no 'n_hours' column, recomputing all days...")
+        return None
+
+    if set(df.columns.drop("n_hours")) != set(capitals_dict.values()):
+        print(f"🔄 Capitals changed since {parquet_path} was written, recomputing all days...")
+        return None
+
+    return df
+
+
+def hours_to_process(hours: list, df_cached: pd.DataFrame) -> list:
+    """
+    Selects the hours whose daily totals are not complete in the cached DataFrame.
+
+    Parameters:
+    - hours (list): Hourly datetimes (UTC) of the requested period.
+    - df_cached (pd.DataFrame): Daily precipitation loaded by load_cached_daily_prec.
+
+    Returns:
+    - list: Hours of the days that are missing from the cache or were computed from fewer than 24 hours.
+    """
+    complete_days = set(df_cached.index[df_cached["n_hours"] >= 24])
+
+    return [dt for dt in hours if ref_time_12z(dt) not in complete_days]
+
+
+def merge_daily_prec(df_cached: pd.DataFrame | None, df_new: pd.DataFrame) -> pd.DataFrame:
+    """
+    Merges newly computed days into the cached ones. When a day is in both, the version computed
+    from more hours is kept (the new one on ties), so a partial recomputation never replaces a more complete day.
+
+    Parameters:
+    - df_cached (pd.DataFrame | None): Daily precipitation loaded by load_cached_daily_prec.
+    - df_new (pd.DataFrame): Newly computed daily precipitation, with the 'n_hours' column.
+
+    Returns:
+    - pd.DataFrame: Merged DataFrame sorted by 'ref_time'.
+    """
+    df = pd.concat([df_cached, df_new])
+
+    # Stable sort, so the new rows stay after the cached ones when n_hours is the same
+    df = df.sort_values("n_hours", kind="stable")
+    df = df[~df.index.duplicated(keep="last")]
+
+    return df.sort_index()
+
+
+def save_daily_prec_parquet(df: pd.DataFrame, parquet_path: str) -> None:
+    """
+    Saves daily precipitation to a Parquet file, quantized to unsigned 16-bit integers.
+
+    Values are stored in units of PREC_SCALE_FACTOR mm (0.01 mm, clipped to 655.35 mm/day),
+    and the scale factor is recorded as 'scale_factor' in the Parquet schema metadata.
+    The 'n_hours' column, if present, is stored as is.
+
+    Parameters:
+    - df (pd.DataFrame): Wide-format DataFrame with 'ref_time' as index and one column per capital (mm).
+    - parquet_path (str): Path to the Parquet file to be written.
+
+    Returns:
+    - None
+    """
+    prec = (df.drop(columns="n_hours", errors="ignore") / PREC_SCALE_FACTOR).round()
+
+    # Values above the uint16 range are clipped (with a warning) rather than failing the whole run
+    max_value = np.iinfo("uint16").max
+    too_large = (prec > max_value).stack()
+    for ref_time, capital in too_large.index[too_large.values]:
+        print(f"⚠️ {capital} on {ref_time}: {df.at[ref_time, capital]:.2f} mm exceeds "
+              f"{max_value * PREC_SCALE_FACTOR:.2f} mm and is stored clipped")
+
+    # Quantize, keeping missing values as nulls
+    df_quantized = prec.clip(0, max_value).astype("UInt16")
+
+    if "n_hours" in df.columns:
+        df_quantized["n_hours"] = df["n_hours"].astype("uint8")
+
+    table = pa.Table.from_pandas(df_quantized)
+    metadata = {**(table.schema.metadata or {}), b"scale_factor": str(PREC_SCALE_FACTOR).encode()}
+
+    pq.write_table(table.replace_schema_metadata(metadata), parquet_path)
+
+
+def load_daily_prec_parquet(parquet_path: str) -> pd.DataFrame:
+    """
+    Loads daily precipitation from a Parquet file written by save_daily_prec_parquet.
+
+    Parameters:
+    - parquet_path (str): Path to the Parquet file.
+
+    Returns:
+    - pd.DataFrame: Wide-format DataFrame with 'ref_time' as index and one column per capital (mm, float32),
+      plus the 'n_hours' column if the file has it.
+    """
+    table = pq.read_table(parquet_path)
+    df = table.to_pandas()
+
+    # Undo the quantization (files without a scale factor already hold mm values)
+    scale_factor = (table.schema.metadata or {}).get(b"scale_factor")
+    if scale_factor is not None:
+        capitals = df.columns.drop("n_hours", errors="ignore")
+        df[capitals] = df[capitals].astype("float32") * np.float32(scale_factor.decode())
+
+    return df
+
+
+def remove_duplicate_ref_times(collection) -> int:
+    """
+    Removes duplicate documents with the same 'ref_time', keeping the most recently inserted one.
+    Collections written before records were upserted hold one copy of each day per run.
+
+    Parameters:
+    - collection (pymongo.collection.Collection): MongoDB collection with daily precipitation documents.
+
+    Returns:
+    - int: Number of documents removed.
+    """
+    # ObjectIds grow with insertion time, so the last _id of each group is the latest document
+    duplicates = collection.aggregate([
+        {"$sort": {"_id": 1}},
+        {"$group": {"_id": "$ref_time", "ids": {"$push": "$_id"}, "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}},
+    ], allowDiskUse=True)
+
+    stale_ids = [_id for group in duplicates for _id in group["ids"][:-1]]
+    if not stale_ids:
+        return 0
+
+    return collection.delete_many({"_id": {"$in": stale_ids}}).deleted_count
+
+
 def save_parquet_to_mongodb(parquet_path: str,
                             db_name: str = "capitals",
                             collection_name: str = "precipitacao_diaria") -> None:
     """
     Reads a Parquet file and saves its content to a MongoDB collection.
+    Records are upserted by 'ref_time', so saving the same days again replaces them instead of duplicating them.
+    Precipitation values are stored as written in the Parquet file (integers in units of PREC_SCALE_FACTOR mm).
 
     Parameters:
     - parquet_path (str): Path to the Parquet file to be inserted.
@@ -228,20 +699,28 @@ def save_parquet_to_mongodb(parquet_path: str,
         raise FileNotFoundError(f"File not found: {parquet_path}")
 
     print(f"📂 Reading Parquet file: {parquet_path}")
-    df = pd.read_parquet(parquet_path)
-
-    # Ensure temporal index is preserved
-    df = df.reset_index()
-
-    print(f"🔄 Converting DataFrame to JSON documents...")
-    data_dict = df.to_dict(orient="records")
+    # The ref_time index is stored as a regular column in the Parquet file
+    table = pq.read_table(parquet_path)
 
     print(f"🔌 Connecting to MongoDB...")
-    client = MongoClient("mongodb://localhost:27017/")
+    client = MongoClient("mongodb://localhost:27017/", w=1, compressors="zstd")
     db = client[db_name]
     collection = db[collection_name]
 
-    print(f"📝 Inserting {len(data_dict)} records into '{db_name}.{collection_name}'...")
-    collection.insert_many(data_dict)
+    # One document per day. Collections from earlier versions may hold duplicated days,
+    # which must be removed once before the unique index can be created
+    if not any(index.get("unique") and index["key"] == [("ref_time", 1)]
+               for index in collection.index_information().values()):
+        removed = remove_duplicate_ref_times(collection)
+        if removed:
+            print(f"🧹 Removed {removed} duplicated documents from '{db_name}.{collection_name}'")
+        collection.create_index("ref_time", unique=True)
+
+    print(f"📝 Upserting {table.num_rows} records into '{db_name}.{collection_name}'...")
+    # Convert and upsert in batches, so only one batch of documents is in memory at a time
+    for batch in table.to_batches(max_chunksize=MONGO_BATCH_SIZE):
+        operations = [UpdateOne({"ref_time": record["ref_time"]}, {"$set": record}, upsert=True)
+                      for record in batch.to_pylist()]
+        collection.bulk_write(operations, ordered=False, bypass_document_validation=True)
 
     print("✅ Data successfully saved to MongoDB.")
\ No newline at end of file